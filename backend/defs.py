@@ -1,11 +1,14 @@
+from typing import Optional
 from pydantic import BaseModel
 
 
 class Job(BaseModel):
     args: str
+    baseline: Optional[str] = None
 
 
 class UpdateJob(BaseModel):
     uuid: str
     status: str
     task: str
+    reason: Optional[str] = None
@@ -1,7 +1,11 @@
 import os
+import tempfile
 
 
 FILES_FOLDER = os.environ.get("FILES_FOLDER", "../worker/files")
+EXPORT_CACHE_FOLDER = os.environ.get(
+    "EXPORT_CACHE_FOLDER", os.path.join(tempfile.gettempdir(), "exports")
+)
 REDIS_HOST = os.environ.get("REDIS_HOST", "localhost")
 
 try:
@@ -14,3 +18,68 @@ RABBITMQ_HOST = os.environ.get("RABBITMQ_HOST", "localhost")
 RABBITMQ_PORT = os.environ.get("RABBITMQ_PORT", "5672")
 
 MAX_ARG_LENGTH = 1000
+
+try:
+    # Seconds between sweeps for jobs whose worker lease has expired.
+    REAPER_INTERVAL = int(os.environ.get("REAPER_INTERVAL", 15))
+    # Number of times a job is requeued after its lease expires before it is
+    # marked as failed.
+    MAX_JOB_RETRIES = int(os.environ.get("MAX_JOB_RETRIES", 3))
+    RETRY_BACKOFF_BASE = int(os.environ.get("RETRY_BACKOFF_BASE", 5))
+    RETRY_BACKOFF_MAX = int(os.environ.get("RETRY_BACKOFF_MAX", 300))
+except ValueError as e:
+    print("Reaper settings must be integers, {}".format(e))
+    exit(1)
+
+try:
+    # Upper bound on the disk space used by cached JSON/NDJSON/CSV exports.
+    EXPORT_CACHE_MAX_BYTES = int(
+        os.environ.get("EXPORT_CACHE_MAX_BYTES", 512 * 1024 * 1024)
+    )
+except ValueError as e:
+    print("EXPORT_CACHE_MAX_BYTES must be an integer, {}".format(e))
+    exit(1)
+
+try:
+    # Fraction of the hosts that were down in a baseline which an incremental
+    # rescan probes again.
+    RESCAN_DOWN_SAMPLE = float(os.environ.get("RESCAN_DOWN_SAMPLE", 0.1))
+    # Most targets an incremental rescan passes to nmap, keeping the job
+    # arguments within what Redis, RabbitMQ and docker handle comfortably.
+    MAX_RESCAN_TARGETS = int(os.environ.get("MAX_RESCAN_TARGETS", 4096))
+except ValueError as e:
+    print("Rescan settings must be numbers, {}".format(e))
+    exit(1)
+
+try:
+    # Minutes of completions the throughput statistics are averaged over.
+    STATS_WINDOW = int(os.environ.get("STATS_WINDOW", 5))
+    # Seconds between statistics summaries sent to event stream subscribers.
+    STATS_INTERVAL = int(os.environ.get("STATS_INTERVAL", 10))
+    # Seconds between recounts of the jobs to repair counter drift.
+    RECONCILE_INTERVAL = int(os.environ.get("RECONCILE_INTERVAL", 300))
+except ValueError as e:
+    print("Statistics settings must be integers, {}".format(e))
+    exit(1)
+
+try:
+    # Connecting to Redis and RabbitMQ on startup is retried indefinitely,
+    # backing off exponentially up to STARTUP_BACKOFF_MAX seconds between
+    # attempts. Failures past STARTUP_RETRIES attempts are logged as critical.
+    STARTUP_RETRIES = int(os.environ.get("STARTUP_RETRIES", 10))
+    STARTUP_BACKOFF_MAX = int(os.environ.get("STARTUP_BACKOFF_MAX", 30))
+except ValueError as e:
+    print("Startup settings must be integers, {}".format(e))
+    exit(1)
+
+try:
+    # Seconds to wait on Redis and RabbitMQ sockets before giving up, so an
+    # unreachable host fails fast instead of hanging until the OS times out.
+    REDIS_SOCKET_TIMEOUT = float(os.environ.get("REDIS_SOCKET_TIMEOUT", 5))
+    RABBITMQ_SOCKET_TIMEOUT = float(os.environ.get("RABBITMQ_SOCKET_TIMEOUT", 5))
+    # Heartbeat interval of the publisher connection, a connection that has
+    # silently dropped is detected within a few intervals.
+    RABBITMQ_HEARTBEAT = int(os.environ.get("RABBITMQ_HEARTBEAT", 30))
+except ValueError as e:
+    print("Connection settings must be numbers, {}".format(e))
+    exit(1)
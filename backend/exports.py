@@ -0,0 +1,231 @@
+import csv
+import io
+import json
+import logging
+import os
+import tempfile
+from typing import Generator, Iterator
+from xml.etree import ElementTree
+
+from env import EXPORT_CACHE_FOLDER, EXPORT_CACHE_MAX_BYTES
+
+logger = logging.getLogger("uvicorn")
+
+# Supported export formats and the media type each is served with.
+EXPORT_FORMATS = {
+    "json": "application/json",
+    "ndjson": "application/x-ndjson",
+    "csv": "text/csv",
+}
+
+CSV_COLUMNS = [
+    "address",
+    "hostname",
+    "status",
+    "protocol",
+    "port",
+    "state",
+    "service",
+    "product",
+    "version",
+]
+
+
+def parse_host(host: ElementTree.Element) -> dict:
+    """Converts a nmap <host> element into a plain dictionary.
+
+    Args:
+        host (ElementTree.Element): The <host> element
+
+    Returns:
+        dict: Host record with its addresses, hostnames and ports
+    """
+    status = host.find("status")
+    addresses = [
+        {"addr": address.get("addr"), "addrtype": address.get("addrtype")}
+        for address in host.findall("address")
+    ]
+    hostnames = [
+        hostname.get("name") for hostname in host.findall("hostnames/hostname")
+    ]
+
+    ports = []
+    for port in host.findall("ports/port"):
+        state = port.find("state")
+        service = port.find("service")
+        ports.append(
+            {
+                "protocol": port.get("protocol"),
+                "port": int(port.get("portid")),
+                "state": state.get("state") if state is not None else None,
+                "service": service.get("name") if service is not None else None,
+                "product": service.get("product") if service is not None else None,
+                "version": service.get("version") if service is not None else None,
+            }
+        )
+
+    return {
+        "address": addresses[0]["addr"] if addresses else None,
+        "addresses": addresses,
+        "hostnames": hostnames,
+        "status": status.get("state") if status is not None else None,
+        "ports": ports,
+    }
+
+
+def iter_hosts(path: str) -> Iterator[dict]:
+    """Incrementally parses a nmap XML file yielding one host at a time. Each
+    host is cleared from the tree once it's been converted so memory use stays
+    constant regardless of the size of the scan.
+
+    Args:
+        path (str): Path to the nmap XML file
+
+    Yields:
+        Iterator[dict]: Host records
+    """
+    root = None
+    for event, elem in ElementTree.iterparse(path, events=("start", "end")):
+        if root is None:
+            root = elem
+        if event == "end" and elem.tag == "host":
+            yield parse_host(elem)
+            root.clear()
+
+
+def convert(path: str, format: str) -> Generator[str, None, None]:
+    """Converts a nmap XML file to the given format, yielding it in chunks.
+
+    Args:
+        path (str): Path to the nmap XML file
+        format (str): One of EXPORT_FORMATS
+
+    Yields:
+        Generator[str, None, None]: Chunks of the converted output
+    """
+    if format == "json":
+        yield "["
+        for index, host in enumerate(iter_hosts(path)):
+            yield ("," if index else "") + json.dumps(host)
+        yield "]"
+
+    elif format == "ndjson":
+        for host in iter_hosts(path):
+            yield json.dumps(host) + "\n"
+
+    elif format == "csv":
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        writer.writerow(CSV_COLUMNS)
+        for host in iter_hosts(path):
+            hostname = host["hostnames"][0] if host["hostnames"] else ""
+            prefix = [host["address"], hostname, host["status"]]
+            for port in host["ports"] or [{}]:
+                writer.writerow(
+                    prefix + [port.get(column) for column in CSV_COLUMNS[3:]]
+                )
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+
+    else:
+        raise ValueError(f"Unknown export format '{format}'")
+
+
+def cache_path(uuid: str, format: str) -> str:
+    return os.path.join(EXPORT_CACHE_FOLDER, f"{uuid}.{format}")
+
+
+def get_cached(uuid: str, format: str, source: str):
+    """Returns the path of a cached conversion if it's newer than its source.
+    Hits are touched so the least recently used entries are evicted first.
+
+    Args:
+        uuid (str): UUID of the job
+        format (str): One of EXPORT_FORMATS
+        source (str): Path to the nmap XML file the export was made from
+
+    Returns:
+        Optional[str]: Path of the cached export or None
+    """
+    path = cache_path(uuid, format)
+    try:
+        if os.path.getmtime(path) < os.path.getmtime(source):
+            return None
+        os.utime(path)
+    except FileNotFoundError:
+        return None
+    return path
+
+
+def stream_export(uuid: str, format: str, source: str) -> Generator[str, None, None]:
+    """Streams the conversion to the client while writing it into the cache.
+    The cache entry only becomes visible once the whole conversion has been
+    written, an interrupted download or unparsable file leaves nothing behind.
+
+    Args:
+        uuid (str): UUID of the job
+        format (str): One of EXPORT_FORMATS
+        source (str): Path to the nmap XML file
+
+    Yields:
+        Generator[str, None, None]: Chunks of the converted output
+    """
+    os.makedirs(EXPORT_CACHE_FOLDER, exist_ok=True)
+    path = cache_path(uuid, format)
+    # Unique per download so concurrent conversions of the same export don't
+    # write into each other's file.
+    fd, tmp_path = tempfile.mkstemp(dir=EXPORT_CACHE_FOLDER, suffix=".tmp")
+
+    complete = False
+    try:
+        with os.fdopen(fd, "w") as f:
+            for chunk in convert(source, format):
+                f.write(chunk)
+                yield chunk
+        complete = True
+    except ElementTree.ParseError as e:
+        # Nmap leaves the XML unterminated when it's interrupted, close off the
+        # document so the client still gets valid output of the hosts parsed.
+        logger.warning(f"Stopped parsing {source}: {str(e)}")
+        if format == "json":
+            yield "]"
+    finally:
+        if complete:
+            os.replace(tmp_path, path)
+            evict()
+        elif os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+def evict():
+    """Removes the least recently used exports until the cache fits within
+    EXPORT_CACHE_MAX_BYTES.
+    """
+    entries = []
+    for entry in os.scandir(EXPORT_CACHE_FOLDER):
+        if entry.is_file() and not entry.name.endswith(".tmp"):
+            stat = entry.stat()
+            entries.append((stat.st_mtime, stat.st_size, entry.path))
+
+    total = sum(size for _, size, _ in entries)
+    for _, size, path in sorted(entries):
+        if total <= EXPORT_CACHE_MAX_BYTES:
+            break
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        total -= size
+
+
+def remove_cached(uuid: str):
+    """Removes every cached export of a job.
+
+    Args:
+        uuid (str): UUID of the job
+    """
+    for format in EXPORT_FORMATS:
+        path = cache_path(uuid, format)
+        if os.path.exists(path):
+            os.remove(path)
@@ -1,8 +1,8 @@
 import asyncio
 import json
 import os
-from time import sleep
-from typing import AsyncGenerator, Generator
+from time import time
+from typing import AsyncGenerator, Optional
 import fastapi
 from fastapi.responses import StreamingResponse
 from pydantic import BaseModel
@@ -10,16 +10,61 @@ from fastapi.middleware.cors import CORSMiddleware
 import uuid
 import logging
 from defs import Job, UpdateJob
-from env import FILES_FOLDER, RABBITMQ_HOST, REDIS_HOST, MAX_ARG_LENGTH
+from exports import EXPORT_FORMATS, get_cached, remove_cached, stream_export
+from rescan import merge_results, select_targets
+from stats import (
+    RETRY_KEY,
+    STARTED_KEY,
+    delete_job,
+    get_stats,
+    reconcile_counters,
+    set_job_status,
+    write_job_status,
+)
+from env import (
+    FILES_FOLDER,
+    EXPORT_CACHE_FOLDER,
+    RABBITMQ_HOST,
+    RABBITMQ_PORT,
+    RABBITMQ_HEARTBEAT,
+    RABBITMQ_SOCKET_TIMEOUT,
+    REDIS_HOST,
+    REDIS_SOCKET_TIMEOUT,
+    MAX_ARG_LENGTH,
+    REAPER_INTERVAL,
+    MAX_JOB_RETRIES,
+    RETRY_BACKOFF_BASE,
+    RETRY_BACKOFF_MAX,
+    STATS_INTERVAL,
+    RECONCILE_INTERVAL,
+    STARTUP_RETRIES,
+    STARTUP_BACKOFF_MAX,
+)
 import pika
 from redis import ConnectionPool, Redis
-from redis.client import PubSub
-from redis.exceptions import ConnectionError
+from redis.client import Pipeline, PubSub
+from pika.adapters.blocking_connection import BlockingChannel
 
 app = fastapi.FastAPI()
 api = fastapi.APIRouter()
 
 active_sse_connections: set = set()
+background_tasks: set = set()
+
+# Shared by every request, connections are opened lazily and reused.
+redis_pool = ConnectionPool.from_url(
+    f"redis://{REDIS_HOST}",
+    decode_responses=True,
+    socket_connect_timeout=REDIS_SOCKET_TIMEOUT,
+    socket_timeout=REDIS_SOCKET_TIMEOUT,
+)
+
+# Publisher channel warmed up on startup, the job queue is declared on it once.
+rabbit_channel: Optional[BlockingChannel] = None
+rabbit_lock = asyncio.Lock()
+
+# Dependencies that have been warmed up, reported by /ready.
+readiness = {"files": False, "redis": False, "rabbitmq": False}
 
 origins = ["*"]
 logger = logging.getLogger("uvicorn")
@@ -34,30 +79,109 @@ app.add_middleware(
 
 
 async def get_redis_client():
-    """Creates a connection to Redis and returns it as a generator.
+    """Returns a client on the shared Redis connection pool as a generator.
 
     Yields:
         Generator[Redis, None, None]: Generator connection to Redis
     """
-    pool = ConnectionPool.from_url(f"redis://{REDIS_HOST}", decode_responses=True)
-    meanings = Redis(connection_pool=pool)
+    meanings = Redis(connection_pool=redis_pool)
     try:
         yield meanings
     finally:
         meanings.close()
 
 
-def get_rabbit_connection() -> Generator[pika.BlockingConnection, None, None]:
-    """Creates a connection to RabbitMQ and returns it as a generator.
+def connect_rabbit() -> BlockingChannel:
+    """Opens a connection to RabbitMQ and declares the job queue on it. The
+    channel has publisher confirms enabled so a publish only returns once the
+    broker has taken the message, and raises otherwise.
+
+    Returns:
+        BlockingChannel: Channel to publish jobs on
+    """
+    connection = pika.BlockingConnection(
+        pika.ConnectionParameters(
+            RABBITMQ_HOST,
+            port=int(RABBITMQ_PORT),
+            heartbeat=RABBITMQ_HEARTBEAT,
+            socket_timeout=RABBITMQ_SOCKET_TIMEOUT,
+        )
+    )
+    channel = connection.channel()
+    channel.queue_declare(queue="job_queue")
+    channel.confirm_delivery()
+    return channel
+
+
+async def reconnect_rabbit(stale: Optional[BlockingChannel]) -> BlockingChannel:
+    """Replaces the shared publisher channel, connecting in a thread so the
+    event loop isn't blocked. Requests that find the same stale channel wait
+    for a single reconnect and then share its channel.
+
+    Args:
+        stale (Optional[BlockingChannel]): Channel that stopped working
+
+    Returns:
+        BlockingChannel: Channel to publish jobs on
+    """
+    global rabbit_channel
+    async with rabbit_lock:
+        current = rabbit_channel
+        if current is not None and current is not stale and current.is_open:
+            return current
+
+        channel = await asyncio.to_thread(connect_rabbit)
+        if stale is not None:
+            try:
+                stale.connection.close()
+            except Exception:
+                pass
+        rabbit_channel = channel
+        return channel
+
+
+async def keep_rabbit_alive():
+    """Services the publisher connection so heartbeats are exchanged while no
+    jobs are being published. A connection that has silently dropped is then
+    closed by pika and reconnected on the next request, rather than a publish
+    waiting on it for its confirm.
+    """
+    while True:
+        await asyncio.sleep(RABBITMQ_HEARTBEAT / 2)
+        # A reconnect in progress replaces the channel
+        if rabbit_lock.locked():
+            continue
+        channel = rabbit_channel
+        if channel is None or not channel.is_open:
+            continue
+        try:
+            channel.connection.process_data_events(time_limit=0)
+        except pika.exceptions.AMQPError as e:
+            logger.error(f"Lost the connection to rabbitmq, {repr(e)}")
+
+
+async def get_rabbit_channel() -> AsyncGenerator[BlockingChannel, None]:
+    """Returns the shared publisher channel as a generator, reconnecting if
+    the connection to RabbitMQ has been lost since it was warmed up.
+
+    Raises:
+        fastapi.HTTPException: Upon RabbitMQ not being reachable
 
     Yields:
-        Generator[pika.BlockingConnection, None, None]: Generator connection to RabbitMQ
+        AsyncGenerator[BlockingChannel, None]: Channel to publish jobs on
     """
-    connection = pika.BlockingConnection(pika.ConnectionParameters(RABBITMQ_HOST))
-    try:
-        yield connection
-    finally:
-        connection.close()
+    # Connecting on startup is left to the warm-up
+    if rabbit_channel is None:
+        raise fastapi.HTTPException(status_code=503, detail="Queue not ready")
+
+    channel = rabbit_channel
+    if not channel.is_open:
+        try:
+            channel = await reconnect_rabbit(channel)
+        except Exception as e:
+            logger.error(f"Cannot reconnect to rabbitmq, {repr(e)}")
+            raise fastapi.HTTPException(status_code=503, detail="Queue unavailable")
+    yield channel
 
 
 def validation_checks(arg: str):
@@ -97,23 +221,227 @@ def validation_checks(arg: str):
         )
 
 
-async def event_stream(request: fastapi.Request, pubsub_channel: PubSub):
-    """Server side event stream generator for real-time updates on jobs
+def validate_uuid(value: str):
+    """Makes sure a job UUID from the request is a UUID before it's used in a
+    file path.
+
+    Args:
+        value (str): UUID from the request
+
+    Raises:
+        fastapi.HTTPException: Upon anything that isn't a UUID
+    """
+    try:
+        uuid.UUID(value)
+    except ValueError:
+        raise fastapi.HTTPException(status_code=400, detail="Invalid job UUID")
+
+
+def publish_job(channel: BlockingChannel, worker_id: str, args: str):
+    """Sends the job to the queue for a worker to pick up.
+
+    Args:
+        channel (BlockingChannel): Channel to RabbitMQ with the queue declared
+        worker_id (str): UUID of the job
+        args (str): Arguments to pass to nmap
+    """
+    message = json.dumps({"uuid": worker_id, "args": args})
+    # Mandatory so a message that can't be routed to the queue raises rather
+    # than being dropped.
+    channel.basic_publish(
+        exchange="", routing_key="job_queue", body=message, mandatory=True
+    )
+
+
+def retry_backoff(attempts: int) -> int:
+    """Capped exponential backoff before a reaped job is requeued.
+
+    Args:
+        attempts (int): Number of times the job has been reaped so far
+
+    Returns:
+        int: Seconds to wait before requeueing
+    """
+    return min(RETRY_BACKOFF_BASE * 2 ** (attempts - 1), RETRY_BACKOFF_MAX)
+
+
+def reap_job(redis: Redis, job_id: str, now: float) -> Optional[dict]:
+    """Schedules a started job to be requeued, or fails it once it's out of
+    retries, if its lease has expired. The job and its lease are watched so a
+    worker finishing the job between the check and the write makes the
+    transaction retry and see the job is no longer started.
+
+    Args:
+        redis (Redis): Connection to redis
+        job_id (str): UUID of the job
+        now (float): Time of the sweep
+
+    Returns:
+        Optional[dict]: Fields written to the job if it was reaped
+    """
+    job_key = f"job:{job_id}"
+    lease_key = f"lease:{job_id}"
+
+    def reap_if_stale(pipe: Pipeline) -> Optional[dict]:
+        status, started_at, attempts, args = pipe.hmget(
+            job_key, "status", "started_at", "attempts", "args"
+        )
+        if status != "Started":
+            pipe.multi()
+            pipe.srem(STARTED_KEY, job_id)
+            return None
+        if pipe.exists(lease_key):
+            return None
+
+        attempts = int(attempts or 0) + 1
+        if not args:
+            update = {
+                "status": "Failed",
+                "reason": "Lease expired and the job has no stored arguments",
+            }
+        elif attempts > MAX_JOB_RETRIES:
+            update = {
+                "status": "Failed",
+                "reason": f"Lease expired after {MAX_JOB_RETRIES} retries",
+            }
+        else:
+            update = {
+                "status": "Queued",
+                "attempts": attempts,
+                "retry_at": now + retry_backoff(attempts),
+            }
+
+        pipe.multi()
+        write_job_status(pipe, job_id, status, started_at, update)
+        return update
+
+    return redis.transaction(
+        reap_if_stale, job_key, lease_key, value_from_callable=True
+    )
+
+
+def reap_stale_jobs(redis: Redis, connect):
+    """Finds started jobs whose worker lease has expired and either schedules
+    them to be requeued or marks them as failed once they run out of retries.
+    Jobs that were scheduled on a previous sweep are published back to the
+    queue once their backoff has elapsed. Only the indexed started and
+    retrying jobs are read, and RabbitMQ is only connected to when a job is
+    due to be published.
+
+    Args:
+        redis (Redis): Connection to redis
+        connect (Callable[[], BlockingChannel]): Returns a channel to RabbitMQ
+            with the queue declared
+    """
+    now = time()
+    for job_id in redis.smembers(STARTED_KEY):
+        update = reap_job(redis, job_id, now)
+        if not update:
+            continue
+
+        if update["status"] == "Queued":
+            logger.warning(f"Job {job_id} lease expired, retry {update['attempts']}")
+        event = {"uuid": job_id, "status": update["status"], "task": "update"}
+        if "reason" in update:
+            event["reason"] = update["reason"]
+        redis.publish("events", json.dumps(event))
+
+    channel = None
+    for job_id in redis.zrangebyscore(RETRY_KEY, "-inf", now):
+        job_key = f"job:{job_id}"
+        status, args, retry_at = redis.hmget(job_key, "status", "args", "retry_at")
+        if status != "Queued" or retry_at is None:
+            redis.zrem(RETRY_KEY, job_id)
+            continue
+
+        if channel is None:
+            channel = connect()
+
+        # Only cleared once published, if the broker is down the job is
+        # picked up again on the next sweep.
+        publish_job(channel, job_id, args)
+        pipe = redis.pipeline()
+        pipe.hdel(job_key, "retry_at")
+        pipe.zrem(RETRY_KEY, job_id)
+        pipe.execute()
+
+
+def run_exclusively(name: str, interval: int, func):
+    """Runs a periodic task in only one backend process per interval, as every
+    gunicorn worker schedules its own copy.
+
+    Args:
+        name (str): Name of the task, used for the lock key
+        interval (int): Seconds the lock is held for
+        func (Callable[[Redis], None]): Task to run with a connection to redis
+    """
+    redis = Redis(connection_pool=redis_pool)
+    try:
+        if redis.set(f"{name}:lock", os.getpid(), nx=True, ex=interval):
+            func(redis)
+    finally:
+        redis.close()
+
+
+def reap(redis: Redis):
+    # The reaper runs in its own thread so it can't share the publisher channel.
+    channels = []
+
+    def connect() -> BlockingChannel:
+        channels.append(connect_rabbit())
+        return channels[0]
+
+    try:
+        reap_stale_jobs(redis, connect)
+    finally:
+        for channel in channels:
+            channel.connection.close()
+
+
+async def run_periodically(name: str, interval: int, func):
+    """Periodically runs a task in a thread so it doesn't block the event loop.
+
+    Args:
+        name (str): Name of the task
+        interval (int): Seconds between runs
+        func (Callable[[Redis], None]): Task to run with a connection to redis
+    """
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            await asyncio.to_thread(run_exclusively, name, interval, func)
+        except Exception as e:
+            logger.error(f"Periodic task {name} failed: {str(e)}")
+
+
+async def event_stream(
+    request: fastapi.Request, pubsub_channel: PubSub, redis: Redis
+):
+    """Server side event stream generator for real-time updates on jobs, along
+    with a "stats" event summarising the job statistics every STATS_INTERVAL
+    seconds.
 
     Args:
         request (fastapi.Request): Request object
         pubsub_channel (PubSub): _description_
+        redis (Redis): Connection to redis used to read the statistics
 
     Yields:
         AsyncGenerator[str, None, None]: Generator of messages
     """
     active_sse_connections.add(request)
+    last_summary = 0.0
     try:
         while True:
             if await request.is_disconnected():
                 break
 
             try:
+                if time() - last_summary >= STATS_INTERVAL:
+                    last_summary = time()
+                    summary = json.dumps(get_stats(redis))
+                    yield f"event: stats\ndata: {summary}\n\n"
+
                 message = pubsub_channel.get_message(
                     ignore_subscribe_messages=True, timeout=0
                 )
@@ -131,7 +459,7 @@ async def event_stream(request: fastapi.Request, pubsub_channel: PubSub):
 @api.post("/job/create")
 async def read_root(
     argsModel: Job,
-    rabbit_connection: pika.BlockingConnection = fastapi.Depends(get_rabbit_connection),
+    channel: BlockingChannel = fastapi.Depends(get_rabbit_channel),
     redis: Redis = fastapi.Depends(get_redis_client),
 ):
     """Creates a new job and returns the UUID of the job
@@ -139,7 +467,10 @@ async def read_root(
     Args:
         request (fastapi.Request): Request object
         response (fastapi.Response): Response object
-        job (Job): Job object, contains the arguments.
+        job (Job): Job object, contains the arguments and optionally the UUID
+            of a completed baseline job. When a baseline is given the arguments
+            are only the nmap options, the targets are the hosts that were up
+            in the baseline plus a sample of the ones that were down.
 
     Returns:
         str: UUID of the job
@@ -151,6 +482,33 @@ async def read_root(
     # offenders like bash special characters.
     validation_checks(argsModel.args)
 
+    args = argsModel.args
+    scope = None
+    if argsModel.baseline:
+        validate_uuid(argsModel.baseline)
+        baseline = redis.hgetall(f"job:{argsModel.baseline}")
+        if not baseline:
+            raise fastapi.HTTPException(status_code=404, detail="Baseline not found")
+
+        file = os.path.join(FILES_FOLDER, f"{argsModel.baseline}.xml")
+        if baseline.get("status") != "Completed" or not os.path.exists(file):
+            raise fastapi.HTTPException(
+                status_code=400, detail="Baseline job has not completed"
+            )
+
+        # Rescans carry the targets of the original scan forward, as their own
+        # arguments only hold the hosts that were picked.
+        scope = baseline.get("scope", baseline.get("args", ""))
+        try:
+            targets = await asyncio.to_thread(select_targets, file, scope)
+        except ValueError as e:
+            raise fastapi.HTTPException(status_code=400, detail=str(e))
+        if not targets:
+            raise fastapi.HTTPException(
+                status_code=400, detail="Baseline has no hosts to rescan"
+            )
+        args = " ".join([args, *targets]).strip()
+
     worker_id = str(uuid.uuid4())
     job = {
         "uuid": worker_id,
@@ -158,40 +516,109 @@ async def read_root(
         "task": "create",
     }
 
-    # Add the queued job to redis
-    redis.hset(f"job:{worker_id}", mapping=job)
+    # Add the queued job to redis, the arguments are kept so the reaper can
+    # requeue the job if its worker dies.
+    stored = {**job, "args": args}
+    if argsModel.baseline:
+        stored["baseline"] = argsModel.baseline
+        stored["scope"] = scope
+    set_job_status(redis, worker_id, stored)
 
     # Publish the job to Redis Pub/Sub so subscribers are updated.
     redis.publish("events", json.dumps(job))
 
-    # Send the job to the queue and then close the connection for cleanup.
-    channel = rabbit_connection.channel()
-    channel.queue_declare(queue="job_queue")
-    message = json.dumps({"uuid": worker_id, "args": argsModel.args})
-    channel.basic_publish(exchange="", routing_key="job_queue", body=message)
+    # Send the job to the queue. A connection dropped since the last publish
+    # only shows up now, so reconnect and try once more before failing the job
+    # rather than leaving it queued forever.
+    try:
+        try:
+            publish_job(channel, worker_id, args)
+        except pika.exceptions.AMQPError as e:
+            logger.warning(
+                f"Publishing job {worker_id} failed, reconnecting, {repr(e)}"
+            )
+            channel = await reconnect_rabbit(channel)
+            publish_job(channel, worker_id, args)
+    except Exception as e:
+        logger.error(f"Cannot publish job {worker_id}, {repr(e)}")
+        failed = {
+            "uuid": worker_id,
+            "status": "Failed",
+            "task": "update",
+            "reason": "Job could not be queued",
+        }
+        set_job_status(redis, worker_id, failed)
+        redis.publish("events", json.dumps(failed))
+        raise fastapi.HTTPException(status_code=503, detail="Queue unavailable")
     return worker_id
 
 
 @api.get("/job/download")
-def download(uuid: str, response: fastapi.Response) -> fastapi.responses.FileResponse:
-    """Downloads the file with the given UUID
+def download(
+    uuid: str, response: fastapi.Response, format: str = "xml"
+) -> fastapi.responses.FileResponse:
+    """Downloads the file with the given UUID, optionally converted from the
+    nmap XML to JSON, NDJSON or CSV. Conversions are streamed and cached so
+    repeated downloads are served straight from disk.
 
     Args:
         uuid (str): UUID of file
-        request (fastapi.Request): Request object
         response (fastapi.Response): Response object
+        format (str, optional): One of xml, json, ndjson or csv. Defaults to "xml".
 
     Returns:
         fastapi.responses.FileResponse: File response object
     """
+    validate_uuid(uuid)
+    if format != "xml" and format not in EXPORT_FORMATS:
+        raise fastapi.HTTPException(
+            status_code=400, detail="Unknown format '{}'".format(format)
+        )
 
     file = os.path.join(FILES_FOLDER, f"{uuid}.xml")
     if not os.path.exists(file):
         response.status_code = 404
         return {"error": "File not found"}
 
+    if format == "xml":
+        return fastapi.responses.FileResponse(
+            file, media_type="application/xml", filename=f"{uuid}.xml"
+        )
+
+    media_type = EXPORT_FORMATS[format]
+    cached = get_cached(uuid, format, file)
+    if cached:
+        return fastapi.responses.FileResponse(
+            cached, media_type=media_type, filename=f"{uuid}.{format}"
+        )
+
+    return StreamingResponse(
+        stream_export(uuid, format, file),
+        media_type=media_type,
+        headers={"Content-Disposition": f'attachment; filename="{uuid}.{format}"'},
+    )
+
+
+@api.get("/job/diff")
+def diff(uuid: str, response: fastapi.Response) -> fastapi.responses.FileResponse:
+    """Downloads the ports and hosts that changed between an incremental
+    rescan and its baseline.
+
+    Args:
+        uuid (str): UUID of the rescan job
+        response (fastapi.Response): Response object
+
+    Returns:
+        fastapi.responses.FileResponse: File response object
+    """
+    validate_uuid(uuid)
+    file = os.path.join(FILES_FOLDER, f"{uuid}.diff.json")
+    if not os.path.exists(file):
+        response.status_code = 404
+        return {"error": "File not found"}
+
     return fastapi.responses.FileResponse(
-        file, media_type="application/xml", filename=f"{uuid}.xml"
+        file, media_type="application/json", filename=f"{uuid}.diff.json"
     )
 
 
@@ -213,7 +640,7 @@ async def sse(
 
     active_sse_connections.add(id(request))
     return StreamingResponse(
-        event_stream(request, pubsub), media_type="text/event-stream"
+        event_stream(request, pubsub, redis), media_type="text/event-stream"
     )
 
 
@@ -222,13 +649,25 @@ async def update_job(job: UpdateJob, redis: Redis = fastapi.Depends(get_redis_cl
     """Updates the job in Redis and publishes the update to Redis Pub/Sub
 
     Args:
-        job (UpdateJob): Job object containing the UUID, status and task
+        job (UpdateJob): Job object containing the UUID, status, task and
+            optionally the reason a job failed
         redis (Redis, optional): Connection to redis. Defaults to fastapi.Depends(get_redis_client).
     """
-    redis.hset(f"job:{job.uuid}", mapping=job.model_dump())
+    # Incremental rescans are merged with their baseline before they're marked
+    # as completed so the download is always the merged result.
+    baseline = redis.hget(f"job:{job.uuid}", "baseline")
+    if job.status == "Completed" and baseline:
+        try:
+            await asyncio.to_thread(merge_results, job.uuid, baseline)
+        except Exception as e:
+            logger.error(f"Failed to merge job {job.uuid} with {baseline}: {str(e)}")
+            job.status = "Failed"
+            job.reason = f"Failed to merge with baseline: {str(e)}"
+
+    set_job_status(redis, job.uuid, job.model_dump(exclude_none=True))
 
     # Also publish job to Redis Pub/Sub so subscribers are updated.
-    redis.publish("events", json.dumps(job.model_dump()))
+    redis.publish("events", json.dumps(job.model_dump(exclude_none=True)))
 
 
 @api.delete("/jobs")
@@ -246,10 +685,9 @@ async def delete_all_completed_jobs(redis: Redis = fastapi.Depends(get_redis_cli
         if job is not None:
             # Check if the job status is 'Completed'
             if job.get("status") == "Completed":
-                redis.delete(job_key)
-
                 # Extract job_id from job_key
                 job_id = job.get("uuid")
+                delete_job(redis, job_id, job.get("status"))
 
                 # Delete the associated file
                 file_path = os.path.join(FILES_FOLDER, f"{job_id}.xml")
@@ -259,6 +697,13 @@ async def delete_all_completed_jobs(redis: Redis = fastapi.Depends(get_redis_cli
                     logger.error(
                         f"File {file_path} not found but corresponding job entry set to be deleted in Redis"
                     )
+                remove_cached(job_id)
+
+                # Incremental rescans also keep the raw scan and a diff
+                for suffix in ["scan.xml", "diff.json"]:
+                    file_path = os.path.join(FILES_FOLDER, f"{job_id}.{suffix}")
+                    if os.path.exists(file_path):
+                        os.remove(file_path)
 
                 # Notify via Redis publish that the job has been deleted
                 job["task"] = "delete"
@@ -283,6 +728,20 @@ async def delete_all_completed_jobs(redis: Redis = fastapi.Depends(get_redis_cli
         logger.debug("No completed jobs found to delete.")
 
 
+@api.get("/job/stats")
+async def job_stats(redis: Redis = fastapi.Depends(get_redis_client)):
+    """Returns the number of jobs in each status and the recent throughput,
+    without reading the jobs themselves.
+
+    Args:
+        redis (Redis, optional): Connection to redis. Defaults to fastapi.Depends(get_redis_client).
+
+    Returns:
+        dict: Job counts per status, completions per minute and mean runtime
+    """
+    return get_stats(redis)
+
+
 @api.get("/job/list")
 async def list_jobs(redis: Redis = fastapi.Depends(get_redis_client)):
     keys = redis.keys("job:*")
@@ -294,35 +753,114 @@ async def list_jobs(redis: Redis = fastapi.Depends(get_redis_client)):
     return jobs
 
 
+async def warm_redis():
+    await asyncio.to_thread(Redis(connection_pool=redis_pool).ping)
+
+
+async def warm_rabbit():
+    await reconnect_rabbit(None)
+
+
+async def connect_with_retries(name: str, connect):
+    """Connects to a dependency, retrying with exponential backoff capped at
+    STARTUP_BACKOFF_MAX until it succeeds, so an instance started before its
+    dependencies becomes ready once they're up. The dependency is marked as
+    ready once it connects.
+
+    Args:
+        name (str): Name of the dependency in readiness
+        connect (Callable[[], Awaitable[None]]): Connects to the dependency
+    """
+    attempt = 0
+    while True:
+        attempt += 1
+        try:
+            await connect()
+            readiness[name] = True
+            return
+        except Exception as e:
+            # Still retried, but it's likely something is misconfigured.
+            log = logger.critical if attempt >= STARTUP_RETRIES else logger.error
+            log(f"Cannot connect to {name} (attempt {attempt}), {repr(e)}")
+            await asyncio.sleep(min(2 ** min(attempt - 1, 16), STARTUP_BACKOFF_MAX))
+
+
+def start_background_task(coroutine):
+    task = asyncio.create_task(coroutine)
+    background_tasks.add(task)
+    task.add_done_callback(background_tasks.discard)
+
+
 @api.on_event("startup")
 async def startup_event():
     """Startup event that does preliminary checks including;
-    - Making sure the files folder exists
-    - Making sure redis is running
+    - Making sure the files and export cache folders exist
+    - Warming up the connections to redis and rabbitmq in the background, the
+      instance reports itself as ready once they've connected
+    - Keeping the rabbitmq connection alive with heartbeats
+    - Starting the stale job reaper and the job counter reconciliation
     """
+    os.makedirs(FILES_FOLDER, exist_ok=True)
+    os.makedirs(EXPORT_CACHE_FOLDER, exist_ok=True)
+    readiness["files"] = True
+
+    start_background_task(connect_with_retries("redis", warm_redis))
+    start_background_task(connect_with_retries("rabbitmq", warm_rabbit))
+    if RABBITMQ_HEARTBEAT:
+        start_background_task(keep_rabbit_alive())
+    start_background_task(run_periodically("reaper", REAPER_INTERVAL, reap))
+    start_background_task(
+        run_periodically("reconcile", RECONCILE_INTERVAL, reconcile_counters)
+    )
+
+    logger.debug("Startup complete")
 
-    # Make sure folder "files" exists
-    if not os.path.exists(FILES_FOLDER):
-        os.makedirs(FILES_FOLDER)
 
-    # Make sure redis is running
-    while True:
-        try:
-            # redis_client = await get_redis_client()
-            break
+@api.get("/ready")
+async def ready(
+    response: fastapi.Response, redis: Redis = fastapi.Depends(get_redis_client)
+):
+    """Readiness check for load balancers. The instance is ready once its
+    dependencies have been warmed up and are still reachable. Redis is pinged
+    and a lost RabbitMQ connection is reconnected on every check.
+
+    Args:
+        response (fastapi.Response): Response object
+        redis (Redis, optional): Connection to redis. Defaults to fastapi.Depends(get_redis_client).
 
-        except ConnectionError as e:
-            logger.error("Cannot connect to redis, {}".format(str(e)))
-            sleep(1)
+    Returns:
+        dict: Whether the instance is ready and the state of each dependency
+    """
+    checks = dict(readiness)
+    try:
+        await asyncio.to_thread(redis.ping)
+        checks["redis"] = True
+    except Exception as e:
+        logger.error(f"Readiness check cannot reach redis, {str(e)}")
+        checks["redis"] = False
+
+    # Before the warm-up has connected it keeps retrying in the background.
+    if rabbit_channel is not None and not rabbit_channel.is_open:
+        try:
+            await reconnect_rabbit(rabbit_channel)
         except Exception as e:
-            logger.error("Unhandled redis exception {}".format(str(e)))
-            sleep(1)
+            logger.error(f"Readiness check cannot reach rabbitmq, {repr(e)}")
+    checks["rabbitmq"] = rabbit_channel is not None and rabbit_channel.is_open
 
-    logger.debug("Startup complete")
+    is_ready = all(checks.values())
+    if not is_ready:
+        response.status_code = 503
+    return {"ready": is_ready, **checks}
 
 
 @api.on_event("shutdown")
 async def shutdown_event():
+    for task in list(background_tasks):
+        task.cancel()
+
+    if rabbit_channel is not None and rabbit_channel.connection.is_open:
+        rabbit_channel.connection.close()
+
     # Attempt to close each SSE connection
     for request in list(active_sse_connections):
         active_sse_connections.remove(request)
@@ -0,0 +1,266 @@
+import json
+import os
+import random
+from ipaddress import ip_address, ip_network
+from typing import Iterator, List
+from xml.etree import ElementTree
+from xml.sax.saxutils import quoteattr
+
+from env import FILES_FOLDER, MAX_RESCAN_TARGETS, RESCAN_DOWN_SAMPLE
+from exports import parse_host
+
+
+def iter_host_elements(path: str) -> Iterator[ElementTree.Element]:
+    """Incrementally parses a nmap XML file yielding the top level elements
+    under <nmaprun>, so hosts along with the scan metadata around them.
+
+    Args:
+        path (str): Path to the nmap XML file
+
+    Yields:
+        Iterator[ElementTree.Element]: Top level elements, each is cleared
+            once the caller has moved on to the next one
+    """
+    depth = 0
+    root = None
+    for event, elem in ElementTree.iterparse(path, events=("start", "end")):
+        if event == "start":
+            if root is None:
+                root = elem
+            depth += 1
+            continue
+
+        depth -= 1
+        if depth == 1:
+            yield elem
+            root.clear()
+
+
+def root_tag(path: str) -> str:
+    """Returns the opening <nmaprun> tag of a nmap XML file with its attributes
+    so they can be carried over into a merged result.
+
+    Args:
+        path (str): Path to the nmap XML file
+
+    Returns:
+        str: The opening tag
+    """
+    for _, elem in ElementTree.iterparse(path, events=("start",)):
+        attributes = "".join(
+            f" {name}={quoteattr(value)}" for name, value in elem.attrib.items()
+        )
+        return f"<{elem.tag}{attributes}>"
+    return "<nmaprun>"
+
+
+def host_addresses(host: dict) -> List[str]:
+    """Returns the IP addresses of a host record, skipping MAC addresses and
+    anything else that isn't a valid nmap target.
+
+    Args:
+        host (dict): Host record from parse_host
+
+    Returns:
+        List[str]: IP addresses of the host
+    """
+    addresses = []
+    for address in host["addresses"]:
+        if address["addrtype"] not in ["ipv4", "ipv6"]:
+            continue
+        try:
+            addresses.append(str(ip_address(address["addr"])))
+        except ValueError:
+            continue
+    return addresses
+
+
+def open_ports(host: dict) -> set:
+    return {
+        (port["protocol"], port["port"])
+        for port in host["ports"]
+        if port["state"] == "open"
+    }
+
+
+def parse_scope(args: str) -> list:
+    """Extracts the IP addresses and CIDR ranges from nmap arguments. Hostnames
+    and nmap's octet range syntax can't be expanded here and are skipped.
+
+    Args:
+        args (str): Arguments a job was run with
+
+    Returns:
+        list: Networks that were scanned
+    """
+    networks = []
+    tokens = args.split()
+    for index, token in enumerate(tokens):
+        # Addresses given to these options aren't targets
+        if index and tokens[index - 1] in ["--exclude", "-S"]:
+            continue
+        try:
+            networks.append(ip_network(token, strict=False))
+        except ValueError:
+            continue
+    return networks
+
+
+def sample_scope(scope: str, exclude: set, limit: int) -> List[str]:
+    """Samples RESCAN_DOWN_SAMPLE of the addresses in scope, without expanding
+    the ranges as IPv6 ones are far too large to, leaving out the ones in
+    exclude.
+
+    Args:
+        scope (str): Arguments holding the targets of the original scan
+        exclude (set): Addresses that shouldn't be sampled
+        limit (int): Most addresses to sample from each range
+
+    Returns:
+        List[str]: Sampled addresses
+    """
+    sample = []
+    for network in parse_scope(scope):
+        size = network.num_addresses
+        count = min(round(size * RESCAN_DOWN_SAMPLE), limit)
+        indexes = set()
+        while len(indexes) < count:
+            indexes.add(random.randrange(size))
+
+        for index in indexes:
+            address = str(network[index])
+            if address not in exclude:
+                sample.append(address)
+    return sample
+
+
+def select_targets(baseline: str, scope: str) -> List[str]:
+    """Picks the hosts to rescan from a baseline result, every host that was
+    up plus a random sample of the rest of the range the baseline covered so
+    hosts that have come up are found. When the range can't be told from the
+    arguments, the hosts the baseline listed as down are sampled instead.
+
+    Args:
+        baseline (str): Path to the baseline nmap XML file
+        scope (str): Arguments holding the targets of the original scan
+
+    Raises:
+        ValueError: Upon more hosts being up than MAX_RESCAN_TARGETS
+
+    Returns:
+        List[str]: IP addresses to pass to nmap, at most MAX_RESCAN_TARGETS
+    """
+    up, down = [], []
+    for elem in iter_host_elements(baseline):
+        if elem.tag != "host":
+            continue
+        host = parse_host(elem)
+        if host["status"] == "up":
+            up.extend(host_addresses(host))
+        else:
+            down.extend(host_addresses(host))
+
+    # Every host that was up has to be rescanned for the diff to be right, only
+    # the sample of down hosts can be cut short.
+    if len(up) > MAX_RESCAN_TARGETS:
+        raise ValueError(
+            "Baseline has {} hosts up, more than the {} that can be rescanned".format(
+                len(up), MAX_RESCAN_TARGETS
+            )
+        )
+
+    limit = MAX_RESCAN_TARGETS - len(up)
+    sample = sample_scope(scope, set(up), limit)
+    if not sample:
+        sample = random.sample(down, round(len(down) * RESCAN_DOWN_SAMPLE))
+    return up + sample[:limit]
+
+
+def merge_results(uuid: str, baseline_uuid: str):
+    """Merges an incremental rescan with its baseline. Hosts that were rescanned
+    replace their baseline entry and the remaining baseline hosts are carried
+    over, so the job's result covers the whole range and can itself be used as
+    a baseline. The raw rescan is kept as <uuid>.scan.xml and the changes since
+    the baseline are written to <uuid>.diff.json.
+
+    Args:
+        uuid (str): UUID of the rescan job
+        baseline_uuid (str): UUID of the baseline job
+    """
+    result = os.path.join(FILES_FOLDER, f"{uuid}.xml")
+    scan = os.path.join(FILES_FOLDER, f"{uuid}.scan.xml")
+    baseline = os.path.join(FILES_FOLDER, f"{baseline_uuid}.xml")
+    os.replace(result, scan)
+
+    # Open ports of every host that was up in the baseline, these were all
+    # rescanned so any host missing from the rescan has gone down.
+    baseline_open = {}
+    for elem in iter_host_elements(baseline):
+        if elem.tag == "host":
+            host = parse_host(elem)
+            if host["status"] == "up":
+                for address in host_addresses(host):
+                    baseline_open[address] = open_ports(host)
+
+    diff = {
+        "baseline": baseline_uuid,
+        "hosts_up": [],
+        "hosts_down": [],
+        "opened": [],
+        "closed": [],
+    }
+    rescanned = set()
+
+    tmp_path = f"{result}.tmp"
+    with open(tmp_path, "w") as f:
+        f.write('<?xml version="1.0" encoding="UTF-8"?>\n')
+        f.write(root_tag(scan) + "\n")
+
+        for elem in iter_host_elements(scan):
+            f.write(ElementTree.tostring(elem, encoding="unicode"))
+            if elem.tag != "host":
+                continue
+
+            host = parse_host(elem)
+            for address in host_addresses(host):
+                rescanned.add(address)
+                was_up = address in baseline_open
+                before = baseline_open.pop(address, set())
+                after = open_ports(host) if host["status"] == "up" else set()
+
+                if host["status"] == "up" and not was_up:
+                    diff["hosts_up"].append(address)
+                elif host["status"] != "up" and was_up:
+                    diff["hosts_down"].append(address)
+
+                changes = [("opened", after - before), ("closed", before - after)]
+                for key, ports in changes:
+                    for protocol, port in sorted(ports):
+                        diff[key].append(
+                            {"address": address, "protocol": protocol, "port": port}
+                        )
+
+        # Baseline hosts that weren't sampled for the rescan are unchanged.
+        for elem in iter_host_elements(baseline):
+            if elem.tag != "host":
+                continue
+            addresses = host_addresses(parse_host(elem))
+            if not rescanned.intersection(addresses) and not any(
+                address in baseline_open for address in addresses
+            ):
+                f.write(ElementTree.tostring(elem, encoding="unicode"))
+
+        f.write("</nmaprun>\n")
+
+    # Whatever is left was up in the baseline but didn't answer the rescan.
+    for address, before in baseline_open.items():
+        diff["hosts_down"].append(address)
+        for protocol, port in sorted(before):
+            diff["closed"].append(
+                {"address": address, "protocol": protocol, "port": port}
+            )
+
+    with open(os.path.join(FILES_FOLDER, f"{uuid}.diff.json"), "w") as f:
+        json.dump(diff, f)
+
+    os.replace(tmp_path, result)
@@ -0,0 +1,185 @@
+import logging
+from collections import Counter
+from time import time
+from typing import Optional
+
+from redis import Redis
+from redis.client import Pipeline
+
+from env import STATS_WINDOW
+
+logger = logging.getLogger("uvicorn")
+
+# Hash of status -> number of jobs currently in that status.
+STATUS_KEY = "stats:status"
+
+STATUSES = ["Queued", "Started", "Completed", "Failed"]
+
+# Jobs the reaper has to look at, so sweeps don't read every stored job. Set
+# of started jobs and sorted set of requeued jobs scored by when they're due.
+STARTED_KEY = "jobs:started"
+RETRY_KEY = "jobs:retry"
+
+
+def window_key(minute: int) -> str:
+    return f"stats:window:{minute}"
+
+
+def write_job_status(
+    pipe: Pipeline,
+    job_id: str,
+    old: Optional[str],
+    started_at: Optional[str],
+    mapping: dict,
+):
+    """Queues the writes of a status change on a pipeline in MULTI mode, so it
+    can be part of a caller's transaction. The job is moved between status
+    counters and the reaper's indexes of started and retrying jobs.
+
+    Args:
+        pipe (Pipeline): Pipeline in MULTI mode
+        job_id (str): UUID of the job
+        old (Optional[str]): Status the job was in
+        started_at (Optional[str]): When the job was started, if it was
+        mapping (dict): Fields to set on the job, usually including the status
+    """
+    job_key = f"job:{job_id}"
+    new = mapping.get("status")
+    now = time()
+
+    fields = dict(mapping)
+    if new == "Started" and old != "Started":
+        fields["started_at"] = now
+    pipe.hset(job_key, mapping=fields)
+
+    if new == "Started":
+        pipe.sadd(STARTED_KEY, job_id)
+        pipe.zrem(RETRY_KEY, job_id)
+    elif new:
+        pipe.srem(STARTED_KEY, job_id)
+        if "retry_at" in mapping:
+            pipe.zadd(RETRY_KEY, {job_id: mapping["retry_at"]})
+        else:
+            pipe.zrem(RETRY_KEY, job_id)
+
+    if not new or new == old:
+        return
+
+    if old:
+        pipe.hincrby(STATUS_KEY, old, -1)
+    pipe.hincrby(STATUS_KEY, new, 1)
+
+    if new == "Completed":
+        bucket = window_key(int(now // 60))
+        pipe.hincrby(bucket, "completions", 1)
+        if started_at:
+            pipe.hincrby(bucket, "timed", 1)
+            pipe.hincrbyfloat(bucket, "runtime", now - float(started_at))
+        pipe.expire(bucket, (STATS_WINDOW + 1) * 60)
+
+
+def set_job_status(redis: Redis, job_id: str, mapping: dict):
+    """Writes the job fields and moves the job between status counters in one
+    transaction. Completions are also recorded in the current minute's
+    throughput bucket along with how long the job ran for.
+
+    Args:
+        redis (Redis): Connection to redis
+        job_id (str): UUID of the job
+        mapping (dict): Fields to set on the job, usually including the status
+    """
+    job_key = f"job:{job_id}"
+
+    def transition(pipe: Pipeline):
+        old, started_at = pipe.hmget(job_key, "status", "started_at")
+        pipe.multi()
+        write_job_status(pipe, job_id, old, started_at, mapping)
+
+    redis.transaction(transition, job_key)
+
+
+def delete_job(redis: Redis, job_id: str, status: Optional[str]):
+    """Deletes the job and removes it from its status counter.
+
+    Args:
+        redis (Redis): Connection to redis
+        job_id (str): UUID of the job
+        status (Optional[str]): Status the job was in
+    """
+    pipe = redis.pipeline()
+    pipe.delete(f"job:{job_id}")
+    pipe.srem(STARTED_KEY, job_id)
+    pipe.zrem(RETRY_KEY, job_id)
+    if status:
+        pipe.hincrby(STATUS_KEY, status, -1)
+    pipe.execute()
+
+
+def get_stats(redis: Redis) -> dict:
+    """Reads the status counters and the throughput over the last
+    STATS_WINDOW minutes, independent of how many jobs are stored.
+
+    Args:
+        redis (Redis): Connection to redis
+
+    Returns:
+        dict: Job counts per status, completions per minute and the mean
+            runtime in seconds of the jobs completed within the window
+    """
+    minute = int(time() // 60)
+    pipe = redis.pipeline()
+    pipe.hgetall(STATUS_KEY)
+    for offset in range(STATS_WINDOW):
+        pipe.hgetall(window_key(minute - offset))
+    counters, *buckets = pipe.execute()
+
+    counts = {status: 0 for status in STATUSES}
+    counts.update({status: int(count) for status, count in counters.items()})
+
+    completions = sum(int(bucket.get("completions", 0)) for bucket in buckets)
+    timed = sum(int(bucket.get("timed", 0)) for bucket in buckets)
+    runtime = sum(float(bucket.get("runtime", 0)) for bucket in buckets)
+
+    return {
+        "counts": counts,
+        "completions_per_minute": completions / STATS_WINDOW,
+        "mean_runtime": runtime / timed if timed else None,
+        "window": STATS_WINDOW,
+    }
+
+
+def reconcile_counters(redis: Redis):
+    """Recounts the jobs in each status and overwrites the counters, repairing
+    drift from crashes between a job write and its counter update. Every
+    status change touches the counters, so they are watched while recounting
+    and the recount is retried if a job changed in the meantime.
+
+    Args:
+        redis (Redis): Connection to redis
+    """
+
+    def recount(pipe: Pipeline):
+        counters = {
+            status: int(count) for status, count in pipe.hgetall(STATUS_KEY).items()
+        }
+
+        reader = redis.pipeline(transaction=False)
+        for job_key in redis.keys("job:*"):
+            reader.hget(job_key, "status")
+        counts = Counter(status for status in reader.execute() if status)
+
+        drift = {
+            status: counts.get(status, 0) - counters.get(status, 0)
+            for status in set(counts) | set(counters)
+            if counts.get(status, 0) != counters.get(status, 0)
+        }
+        if not drift:
+            return
+
+        logger.warning(f"Repairing job counter drift: {drift}")
+        pipe.multi()
+        pipe.delete(STATUS_KEY)
+        if counts:
+            pipe.hset(STATUS_KEY, mapping=dict(counts))
+
+    redis.transaction(recount, STATUS_KEY)
@@ -2,9 +2,14 @@ import os
 import fakeredis
 from fastapi.testclient import TestClient
 import pytest
-from main import app, get_rabbit_connection, get_redis_client
+import main
+from main import app, get_rabbit_channel, get_redis_client, reap_stale_jobs
+from stats import RETRY_KEY, STARTED_KEY, STATUS_KEY, reconcile_counters
+import rescan
 import pika
-from env import FILES_FOLDER
+import redis
+from env import FILES_FOLDER, MAX_JOB_RETRIES
+from exports import cache_path
 
 
 class BlockingConnection(pika.BlockingConnection):
@@ -15,6 +20,8 @@ class BlockingConnection(pika.BlockingConnection):
         pika (_type_): _description_
     """
 
+    is_open = True
+
     def __init__(self, *args, **kwargs):
         pass
 
@@ -47,7 +54,7 @@ def redis_client():
 
 @pytest.fixture(scope="function")
 def client(redis_client: fakeredis.FakeStrictRedis):
-    app.dependency_overrides[get_rabbit_connection] = get_rabbit_connection_mock
+    app.dependency_overrides[get_rabbit_channel] = get_rabbit_connection_mock
     app.dependency_overrides[get_redis_client] = lambda: redis_client
 
     # Startup code doesn't get called so doing it manually.
@@ -175,6 +182,79 @@ def test_download(client: TestClient):
     assert response.status_code == 405
 
 
+NMAP_XML = """<?xml version="1.0" encoding="UTF-8"?>
+<nmaprun scanner="nmap" args="nmap -oX - localhost">
+<host><status state="up" reason="localhost-response"/>
+<address addr="127.0.0.1" addrtype="ipv4"/>
+<hostnames><hostname name="localhost" type="user"/></hostnames>
+<ports>
+<port protocol="tcp" portid="22"><state state="open"/><service name="ssh"/></port>
+<port protocol="tcp" portid="80"><state state="closed"/><service name="http"/></port>
+</ports>
+</host>
+<host><status state="down" reason="no-response"/>
+<address addr="127.0.0.2" addrtype="ipv4"/>
+</host>
+</nmaprun>
+"""
+
+
+def test_download_formats(client: TestClient):
+    response = client.post("/api/job/create", json={"args": "localhost"})
+    uuid = response.json()
+
+    with open(os.path.join(FILES_FOLDER, f"{uuid}.xml"), "w") as f:
+        f.write(NMAP_XML)
+
+    response = client.get(f"/api/job/download?uuid={uuid}&format=json")
+    assert response.status_code == 200
+    hosts = response.json()
+    assert [host["address"] for host in hosts] == ["127.0.0.1", "127.0.0.2"]
+    assert hosts[0]["ports"][0] == {
+        "protocol": "tcp",
+        "port": 22,
+        "state": "open",
+        "service": "ssh",
+        "product": None,
+        "version": None,
+    }
+
+    # The conversion is cached and served from disk on the next download
+    assert os.path.exists(cache_path(uuid, "json"))
+    response = client.get(f"/api/job/download?uuid={uuid}&format=json")
+    assert response.json() == hosts
+
+    response = client.get(f"/api/job/download?uuid={uuid}&format=ndjson")
+    assert response.status_code == 200
+    assert len(response.text.splitlines()) == 2
+
+    response = client.get(f"/api/job/download?uuid={uuid}&format=csv")
+    assert response.status_code == 200
+    rows = response.text.splitlines()
+    assert rows[0].startswith("address,hostname")
+    assert len(rows) == 4  # Header, two ports and the host that's down
+
+    response = client.get(f"/api/job/download?uuid={uuid}&format=yaml")
+    assert response.status_code == 400
+
+    # Only UUIDs are used in file paths
+    response = client.get("/api/job/download?uuid=../../etc/passwd&format=json")
+    assert response.status_code == 400
+
+    # Truncated output still converts to valid JSON
+    with open(os.path.join(FILES_FOLDER, f"{uuid}.xml"), "w") as f:
+        f.write(NMAP_XML[: NMAP_XML.index("<host><status state=\"down\"")])
+
+    response = client.get(f"/api/job/download?uuid={uuid}&format=json")
+    assert len(response.json()) == 1
+
+    # Cleanup
+    os.remove(os.path.join(FILES_FOLDER, f"{uuid}.xml"))
+    for format in ["json", "ndjson", "csv"]:
+        if os.path.exists(cache_path(uuid, format)):
+            os.remove(cache_path(uuid, format))
+
+
 def test_delete_jobs(client: TestClient):
     response = client.post("/api/job/create", json={"args": "localhost"})
     assert response.status_code == 200
@@ -219,3 +299,355 @@ def test_delete_jobs(client: TestClient):
 
     response = client.get("/api/jobs")
     assert response.status_code == 405
+
+
+def test_reap_stale_jobs(client: TestClient, redis_client: fakeredis.FakeStrictRedis):
+    response = client.post("/api/job/create", json={"args": "localhost"})
+    uuid = response.json()
+
+    response = client.patch(
+        "/api/job/update",
+        json={"uuid": uuid, "task": "update", "status": "Started"},
+    )
+    assert response.status_code == 200
+
+    # A job holding a lease is left alone
+    redis_client.set(f"lease:{uuid}", "worker")
+    reap_stale_jobs(redis_client, BlockingConnection)
+    assert redis_client.hget(f"job:{uuid}", "status") == "Started"
+
+    # Once the lease expires the job is scheduled to be requeued
+    redis_client.delete(f"lease:{uuid}")
+    reap_stale_jobs(redis_client, BlockingConnection)
+    job = redis_client.hgetall(f"job:{uuid}")
+    assert job["status"] == "Queued"
+    assert job["attempts"] == "1"
+    assert "retry_at" in job
+
+    # After the backoff has elapsed it's published to the queue again, unless
+    # the broker is down in which case it's kept for the next sweep
+    class BrokerDown(BlockingConnection):
+        def basic_publish(self, *args, **kwargs):
+            raise pika.exceptions.AMQPConnectionError()
+
+    redis_client.hset(f"job:{uuid}", "retry_at", 0)
+    redis_client.zadd(RETRY_KEY, {uuid: 0})
+    with pytest.raises(pika.exceptions.AMQPConnectionError):
+        reap_stale_jobs(redis_client, BrokerDown)
+    assert redis_client.hget(f"job:{uuid}", "retry_at") == "0"
+
+    reap_stale_jobs(redis_client, BlockingConnection)
+    assert "retry_at" not in redis_client.hgetall(f"job:{uuid}")
+    assert redis_client.zcard(RETRY_KEY) == 0
+
+    # Running out of retries marks the job as failed with a reason, which
+    # doesn't need the broker so nothing connects to it
+    client.patch(
+        "/api/job/update",
+        json={"uuid": uuid, "task": "update", "status": "Started"},
+    )
+    redis_client.hset(f"job:{uuid}", "attempts", MAX_JOB_RETRIES)
+
+    def unreachable():
+        raise pika.exceptions.AMQPConnectionError()
+
+    reap_stale_jobs(redis_client, unreachable)
+
+    response = client.get("/api/job/list")
+    job = response.json()[0]
+    assert job["status"] == "Failed"
+    assert "reason" in job
+    assert redis_client.scard(STARTED_KEY) == 0
+
+
+def test_reap_finished_job(
+    client: TestClient, redis_client: fakeredis.FakeStrictRedis, monkeypatch
+):
+    uuid = client.post("/api/job/create", json={"args": "localhost"}).json()
+    client.patch(
+        "/api/job/update",
+        json={"uuid": uuid, "task": "update", "status": "Started"},
+    )
+
+    # The worker completes the job and releases its lease right after the
+    # reaper has read it as started
+    transaction = redis_client.transaction
+    flipped = []
+
+    def complete_after_read(func, *watches, **kwargs):
+        if flipped:
+            return transaction(func, *watches, **kwargs)
+
+        def read_then_complete(pipe):
+            hmget = pipe.hmget
+
+            def hmget_then_complete(*args):
+                values = hmget(*args)
+                if not flipped:
+                    flipped.append(True)
+                    client.patch(
+                        "/api/job/update",
+                        json={"uuid": uuid, "task": "update", "status": "Completed"},
+                    )
+                return values
+
+            pipe.hmget = hmget_then_complete
+            return func(pipe)
+
+        return transaction(read_then_complete, *watches, **kwargs)
+
+    monkeypatch.setattr(redis_client, "transaction", complete_after_read)
+    reap_stale_jobs(redis_client, BlockingConnection)
+    monkeypatch.undo()
+    assert flipped
+
+    job = redis_client.hgetall(f"job:{uuid}")
+    assert job["status"] == "Completed"
+    assert "retry_at" not in job
+    stats = client.get("/api/job/stats").json()
+    assert stats["counts"]["Completed"] == 1
+    assert stats["counts"]["Queued"] == 0
+
+
+def test_job_update_reason(client: TestClient):
+    response = client.post("/api/job/create", json={"args": "localhost"})
+    uuid = response.json()
+
+    response = client.patch(
+        "/api/job/update",
+        json={
+            "uuid": uuid,
+            "task": "update",
+            "status": "Failed",
+            "reason": "Container exited with code 1",
+        },
+    )
+    assert response.status_code == 200
+
+    response = client.get("/api/job/list")
+    assert response.json()[0]["reason"] == "Container exited with code 1"
+
+
+RESCAN_XML = """<?xml version="1.0" encoding="UTF-8"?>
+<nmaprun scanner="nmap" args="nmap -oX - -p 22,80 127.0.0.1 127.0.0.3">
+<host><status state="up" reason="localhost-response"/>
+<address addr="127.0.0.1" addrtype="ipv4"/>
+<ports>
+<port protocol="tcp" portid="22"><state state="filtered"/><service name="ssh"/></port>
+<port protocol="tcp" portid="80"><state state="open"/><service name="http"/></port>
+</ports>
+</host>
+</nmaprun>
+"""
+
+
+def test_incremental_rescan(
+    client: TestClient,
+    redis_client: fakeredis.FakeStrictRedis,
+    monkeypatch: pytest.MonkeyPatch,
+):
+    response = client.post(
+        "/api/job/create", json={"args": "-p 22,80", "baseline": "missing"}
+    )
+    assert response.status_code == 400
+
+    response = client.post(
+        "/api/job/create",
+        json={"args": "-p 22,80", "baseline": "417b0f97-882e-4a1b-8408-d90c061c283b"},
+    )
+    assert response.status_code == 404
+
+    baseline = client.post("/api/job/create", json={"args": "localhost"}).json()
+
+    # Baseline hasn't finished so it can't be used yet
+    response = client.post(
+        "/api/job/create", json={"args": "-p 22,80", "baseline": baseline}
+    )
+    assert response.status_code == 400
+
+    with open(os.path.join(FILES_FOLDER, f"{baseline}.xml"), "w") as f:
+        f.write(
+            NMAP_XML.replace(
+                "</nmaprun>",
+                """<host><status state="up"/>
+<address addr="127.0.0.3" addrtype="ipv4"/>
+<ports><port protocol="tcp" portid="443"><state state="open"/></port></ports>
+</host>
+</nmaprun>""",
+            )
+        )
+    client.patch(
+        "/api/job/update",
+        json={"uuid": baseline, "task": "update", "status": "Completed"},
+    )
+
+    response = client.post(
+        "/api/job/create", json={"args": "-p 22,80", "baseline": baseline}
+    )
+    assert response.status_code == 200
+    uuid = response.json()
+
+    # Only hosts that were up are rescanned, the down host isn't sampled
+    args = redis_client.hget(f"job:{uuid}", "args")
+    assert args == "-p 22,80 127.0.0.1 127.0.0.3"
+
+    # 22 has closed, 80 has opened and 127.0.0.3 no longer responds
+    with open(os.path.join(FILES_FOLDER, f"{uuid}.xml"), "w") as f:
+        f.write(RESCAN_XML)
+
+    response = client.patch(
+        "/api/job/update",
+        json={"uuid": uuid, "task": "update", "status": "Completed"},
+    )
+    assert response.status_code == 200
+    assert redis_client.hget(f"job:{uuid}", "status") == "Completed"
+
+    response = client.get(f"/api/job/diff?uuid={uuid}")
+    assert response.status_code == 200
+    diff = response.json()
+    assert diff["baseline"] == baseline
+    assert diff["hosts_down"] == ["127.0.0.3"]
+    assert diff["opened"] == [{"address": "127.0.0.1", "protocol": "tcp", "port": 80}]
+    assert diff["closed"] == [
+        {"address": "127.0.0.1", "protocol": "tcp", "port": 22},
+        {"address": "127.0.0.3", "protocol": "tcp", "port": 443},
+    ]
+
+    # The merged result carries over the baseline host that wasn't rescanned
+    response = client.get(f"/api/job/download?uuid={uuid}&format=json")
+    hosts = [host["address"] for host in response.json()]
+    assert hosts == ["127.0.0.1", "127.0.0.2"]
+
+    # The rest of the baseline's range is sampled for hosts that came up, and
+    # the range is carried forward for rescans of this rescan
+    monkeypatch.setattr(rescan, "RESCAN_DOWN_SAMPLE", 1)
+    targets = rescan.select_targets(
+        os.path.join(FILES_FOLDER, f"{baseline}.xml"), "-p 22 127.0.0.0/30"
+    )
+    assert sorted(targets) == ["127.0.0.0", "127.0.0.1", "127.0.0.2", "127.0.0.3"]
+
+    # IPv6 ranges are sampled without being expanded
+    monkeypatch.setattr(rescan, "MAX_RESCAN_TARGETS", 10)
+    targets = rescan.select_targets(
+        os.path.join(FILES_FOLDER, f"{baseline}.xml"), "-6 2001:db8::/64"
+    )
+    assert len(targets) == 10
+    assert all(target.startswith("2001:db8::") for target in targets[2:])
+
+    response = client.post(
+        "/api/job/create", json={"args": "-p 22,80", "baseline": uuid}
+    )
+    assert redis_client.hget(f"job:{response.json()}", "scope") == "localhost"
+
+    # Every host that was up has to fit within the target limit
+    monkeypatch.setattr(rescan, "MAX_RESCAN_TARGETS", 1)
+    response = client.post(
+        "/api/job/create", json={"args": "-p 22,80", "baseline": baseline}
+    )
+    assert response.status_code == 400
+
+    response = client.delete("/api/jobs")
+    assert response.status_code == 200
+    assert os.listdir(FILES_FOLDER) == []
+
+
+def test_job_stats(client: TestClient, redis_client: fakeredis.FakeStrictRedis):
+    response = client.get("/api/job/stats")
+    assert response.status_code == 200
+    assert response.json()["counts"] == {
+        "Queued": 0,
+        "Started": 0,
+        "Completed": 0,
+        "Failed": 0,
+    }
+
+    first = client.post("/api/job/create", json={"args": "localhost"}).json()
+    client.post("/api/job/create", json={"args": "localhost"})
+    for status in ["Started", "Completed"]:
+        client.patch(
+            "/api/job/update",
+            json={"uuid": first, "task": "update", "status": status},
+        )
+
+    stats = client.get("/api/job/stats").json()
+    assert stats["counts"]["Queued"] == 1
+    assert stats["counts"]["Started"] == 0
+    assert stats["counts"]["Completed"] == 1
+    assert stats["completions_per_minute"] == 1 / stats["window"]
+    assert stats["mean_runtime"] is not None
+
+    client.delete("/api/jobs")
+    stats = client.get("/api/job/stats").json()
+    assert stats["counts"]["Completed"] == 0
+
+    # Drifted counters are repaired from the stored jobs
+    redis_client.hset(STATUS_KEY, mapping={"Queued": 5, "Failed": 2})
+    reconcile_counters(redis_client)
+    stats = client.get("/api/job/stats").json()
+    assert stats["counts"]["Queued"] == 1
+    assert stats["counts"]["Failed"] == 0
+
+    # Invalid methods
+    response = client.post("/api/job/stats")
+    assert response.status_code == 405
+
+
+def test_ready(client: TestClient, monkeypatch: pytest.MonkeyPatch):
+    # Dependencies haven't been warmed up
+    response = client.get("/api/ready")
+    assert response.status_code == 503
+    assert response.json()["ready"] is False
+
+    monkeypatch.setattr(main, "rabbit_channel", BlockingConnection())
+    for name in main.readiness:
+        monkeypatch.setitem(main.readiness, name, True)
+
+    response = client.get("/api/ready")
+    assert response.status_code == 200
+    assert response.json() == {
+        "ready": True,
+        "files": True,
+        "redis": True,
+        "rabbitmq": True,
+    }
+
+    # Redis stopped answering
+    def unreachable():
+        raise redis.exceptions.TimeoutError("Timeout reading from socket")
+
+    monkeypatch.setattr(fakeredis.FakeStrictRedis, "ping", lambda self: unreachable())
+    response = client.get("/api/ready")
+    assert response.status_code == 503
+    assert response.json()["redis"] is False
+
+    # Invalid methods
+    response = client.post("/api/ready")
+    assert response.status_code == 405
+
+
+def test_job_create_reconnects(
+    client: TestClient,
+    redis_client: fakeredis.FakeStrictRedis,
+    monkeypatch: pytest.MonkeyPatch,
+):
+    class ConnectionLost(BlockingConnection):
+        def basic_publish(self, *args, **kwargs):
+            raise pika.exceptions.StreamLostError()
+
+    app.dependency_overrides[get_rabbit_channel] = lambda: ConnectionLost()
+
+    # The publish is retried once on a fresh connection
+    monkeypatch.setattr(main, "rabbit_channel", None)
+    monkeypatch.setattr(main, "connect_rabbit", lambda: BlockingConnection())
+    response = client.post("/api/job/create", json={"args": "localhost"})
+    assert response.status_code == 200
+    assert redis_client.hget(f"job:{response.json()}", "status") == "Queued"
+
+    # If that fails too the job is failed rather than left queued
+    monkeypatch.setattr(main, "rabbit_channel", None)
+    monkeypatch.setattr(main, "connect_rabbit", lambda: ConnectionLost())
+    response = client.post("/api/job/create", json={"args": "localhost"})
+    assert response.status_code == 503
+
+    jobs = client.get("/api/job/list").json()
+    assert sorted(job["status"] for job in jobs) == ["Failed", "Queued"]
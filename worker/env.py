@@ -12,3 +12,11 @@ except ValueError as e:
 
 RABBITMQ_HOST = os.environ.get("RABBITMQ_HOST", "localhost")
 RABBITMQ_PORT = os.environ.get("RABBITMQ_PORT", "5672")
+
+try:
+    # Seconds a job lease lives without being renewed. The worker renews it
+    # every third of this period while the scan is running.
+    LEASE_TTL = int(os.environ.get("LEASE_TTL", 30))
+except ValueError as e:
+    print("LEASE_TTL must be an integer, {}".format(e))
+    exit(1)
@@ -1,12 +1,22 @@
 import json
 import os
 import socket
+import threading
+import uuid
 from time import sleep
+from typing import Optional
 from pika.spec import Basic, BasicProperties
 from pika.adapters.blocking_connection import BlockingChannel
 import pika
 import requests
-from env import FILES_FOLDER, RABBITMQ_HOST, RABBITMQ_PORT, REDIS_HOST, REDIS_PORT
+from env import (
+    FILES_FOLDER,
+    LEASE_TTL,
+    RABBITMQ_HOST,
+    RABBITMQ_PORT,
+    REDIS_HOST,
+    REDIS_PORT,
+)
 import redis
 import docker
 from pika.exceptions import (
@@ -14,6 +24,30 @@ from pika.exceptions import (
     ChannelWrongStateError,
 )
 
+# Identifies this worker as the holder of a job lease.
+WORKER_ID = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4()}"
+
+# Extends the lease only while this worker holds it, taking it again if it
+# expired in between. Returns 0 once another worker has taken the lease over.
+RENEW_LEASE = """
+local holder = redis.call("get", KEYS[1])
+if holder == ARGV[1] then
+    return redis.call("expire", KEYS[1], ARGV[2])
+elseif not holder then
+    redis.call("set", KEYS[1], ARGV[1], "NX", "EX", ARGV[2])
+    return 1
+end
+return 0
+"""
+
+# Deletes the lease only while this worker holds it.
+RELEASE_LEASE = """
+if redis.call("get", KEYS[1]) == ARGV[1] then
+    return redis.call("del", KEYS[1])
+end
+return 0
+"""
+
 
 class Job:
     def __init__(self, args: str, uuid: str):
@@ -24,6 +58,64 @@ class Job:
         return f"Job ({self.uuid}): {self.args}"
 
 
+def update_status(uuid: str, status: str, reason: Optional[str] = None):
+    """Reports the job status back to the API so it is stored and broadcast to
+    subscribers.
+
+    Args:
+        uuid (str): UUID of the job
+        status (str): New status of the job
+        reason (Optional[str]): Why the job failed, if it did
+    """
+    body = {"uuid": uuid, "status": status, "task": "update"}
+    if reason is not None:
+        body["reason"] = reason
+
+    res = requests.patch("http://localhost:8000/api/job/update", json=body)
+    if res.status_code != 200:
+        print("Failed to update status...", res.text)
+
+
+class Lease:
+    """Holds a renewable lease on a job in Redis. The backend reaper treats a
+    started job without a lease as abandoned and requeues it, so the lease is
+    renewed in the background for as long as the scan runs.
+    """
+
+    def __init__(self, redis_client: redis.Redis, uuid: str):
+        self.redis_client = redis_client
+        self.key = f"lease:{uuid}"
+        self.stop = threading.Event()
+        self.thread = threading.Thread(target=self.renew, daemon=True)
+        self.renew_script = redis_client.register_script(RENEW_LEASE)
+        self.release_script = redis_client.register_script(RELEASE_LEASE)
+
+    def acquire(self):
+        self.redis_client.set(self.key, WORKER_ID, ex=LEASE_TTL)
+        self.thread.start()
+
+    def renew(self):
+        while not self.stop.wait(LEASE_TTL / 3):
+            try:
+                renewed = self.renew_script(
+                    keys=[self.key], args=[WORKER_ID, LEASE_TTL]
+                )
+            except redis.exceptions.RedisError as e:
+                print("Failed to renew lease...", e)
+                continue
+
+            # The job was requeued and another worker holds the lease now,
+            # leave it to them.
+            if not renewed:
+                print("Lease taken over by another worker...", self.key)
+                return
+
+    def release(self):
+        self.stop.set()
+        self.thread.join()
+        self.release_script(keys=[self.key], args=[WORKER_ID])
+
+
 def worker(
     ch: BlockingChannel, method: Basic.Deliver, prop: BasicProperties, body: bytes
 ):
@@ -40,56 +132,56 @@ def worker(
     redis_client = redis.Redis(host=REDIS_HOST, port=REDIS_PORT, db=0)
 
     client = docker.from_env()
-    redis_client.set(job.uuid, "Started")
 
-    res = requests.patch(
-        "http://localhost:8000/api/job/update",
-        json={"uuid": job.uuid, "status": "Started", "task": "update"},
-    )
+    # The lease has to exist before the job is reported as started, otherwise
+    # the reaper could requeue it in between.
+    lease = Lease(redis_client, job.uuid)
+    lease.acquire()
 
-    if res.status_code != 200:
-        print("Failed to update status...", res.text)
-
-    try:
-        container = client.containers.run(
-            "instrumentisto/nmap", f"-oX - {job.args}", detach=False, remove=True
-        )
-
-    except docker.errors.ContainerError as e:
-        print(e)
-        redis_client.set(job.uuid, str(e))
-        return
-    except Exception as e:
-        print(e)
-        redis_client.set(job.uuid, f"Unhandled container exception: {str(e)}")
-        return
-
-    # Set in the database.
+    # If anything below raises unexpectedly the lease is still released, and
+    # the reaper requeues the job as it's left in the started state.
     try:
-        res = container.decode("utf-8")
-    except UnicodeDecodeError as e:
-        print(e)
-        redis_client.set(job.uuid, f"Nmap returned format unknown to UTF-8: {str(e)}")
-        return
-    except Exception as e:
-        print(e)
-        redis_client.set(job.uuid, f"Unhandled decode exception: {str(e)}")
-
-    # write to S3 bucket/cdn or alternative
-    path = os.path.join(FILES_FOLDER, f"{job.uuid}.xml")
-    with open(path, "w") as f:
-        f.write(res)
-
-    redis_client.set(job.uuid, "Completed")
-    redis_client.close()
-
-    res = requests.patch(
-        "http://localhost:8000/api/job/update",
-        json={"uuid": job.uuid, "status": "Completed", "task": "update"},
-    )
+        update_status(job.uuid, "Started")
 
-    if res.status_code != 200:
-        print("Failed to update status...", res.text)
+        try:
+            container = client.containers.run(
+                "instrumentisto/nmap", f"-oX - {job.args}", detach=False, remove=True
+            )
+
+        except docker.errors.ContainerError as e:
+            print(e)
+            update_status(job.uuid, "Failed", str(e))
+            return
+        except Exception as e:
+            print(e)
+            update_status(
+                job.uuid, "Failed", f"Unhandled container exception: {str(e)}"
+            )
+            return
+
+        # Set in the database.
+        try:
+            res = container.decode("utf-8")
+        except UnicodeDecodeError as e:
+            print(e)
+            update_status(
+                job.uuid, "Failed", f"Nmap returned format unknown to UTF-8: {str(e)}"
+            )
+            return
+        except Exception as e:
+            print(e)
+            update_status(job.uuid, "Failed", f"Unhandled decode exception: {str(e)}")
+            return
+
+        # write to S3 bucket/cdn or alternative
+        path = os.path.join(FILES_FOLDER, f"{job.uuid}.xml")
+        with open(path, "w") as f:
+            f.write(res)
+
+        update_status(job.uuid, "Completed")
+    finally:
+        lease.release()
+        redis_client.close()
 
     print("Job completed")
 
@@ -118,6 +210,8 @@ def main():
     while True:
         try:
             channel.basic_qos(prefetch_count=1)
+            # Messages are acked on delivery, redelivery of jobs from crashed
+            # workers is left to the backend reaper through job leases.
             channel.basic_consume(
                 queue="job_queue",
                 on_message_callback=worker,